@@ -1,21 +1,29 @@
+import asyncio
+import aiohttp
+import atexit
 import discord
-import json
+import html
+from discord.ext import commands
+import orjson
+import re
 import logging
-import requests
-from bs4 import BeautifulSoup
 import sqlite3
-from datetime import datetime
+from urllib.parse import urlsplit
+import time
+import weakref
+import zoneinfo
 
 # --- Configuration & Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 
 def load_config():
     try:
-        with open('config.json', 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, KeyError):
-        logging.critical("FATAL: 'config.json' is missing or malformed.")
+        with open('config.json', 'rb') as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, KeyError, orjson.JSONDecodeError):
+        logger.critical("FATAL: 'config.json' is missing or malformed.")
         exit()
 
 
@@ -23,196 +31,369 @@ CONFIG = load_config()
 TOKEN = CONFIG['token']
 ORACLE_API_URL = CONFIG['oracle_api_url']
 DB_FILE = "chronicle.db"
+EMBED_DESCRIPTION_LIMIT = 4096  # Discord rejects embeds whose description is longer than this.
+
+# A single connection is opened in initialize_database() and reused by every handler.
+DB_CONN = None
+DB_WRITE_LOCK = None  # asyncio primitives are created in setup_hook() so they bind to the bot's event loop.
+
+# !log rows are queued and written in batches by log_writer(), so a burst shares one commit.
+LOG_QUEUE = None
+LOG_FLUSH_INTERVAL = 0.1  # Seconds to wait for more rows before committing a batch.
+LOG_WRITER_TASK = None
+
+# timestamp holds UTC nanoseconds since the epoch (time.time_ns()); display_ts is the pre-rendered string.
+SQL_CREATE_LOGS = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp INTEGER NOT NULL,
+        user TEXT NOT NULL,
+        message TEXT NOT NULL,
+        display_ts TEXT
+    )
+"""
+DISPLAY_TS_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
+
+# Kept as constants so the connection's prepared-statement cache is hit on every call.
+SQL_INSERT_LOG = "INSERT INTO logs (timestamp, display_ts, user, message) VALUES (?, ?, ?, ?)"
+# The newest 'limit' rows are read backwards along the rowid, then returned oldest-first.
+SQL_SELECT_RECENT = (
+    "SELECT display_ts, user, message FROM "
+    "(SELECT id, display_ts, user, message FROM logs ORDER BY id DESC LIMIT ?) ORDER BY id"
+)
+
+# Shared aiohttp session, created in setup_hook(). Its connector pools keep-alive connections and,
+# unlike requests, never blocks the gateway event loop while waiting on the network.
+HTTP = None
+HTTP_HEADERS = {'User-Agent': 'Seymore-Bawts-Echo-Probe/1.0'}
+# Known IANA zone names, used to reject typos before calling the Oracle. Empty if the host has no tz database,
+# in which case validation is skipped and the Oracle decides.
+VALID_TZ = zoneinfo.available_timezones()
+# Oracle responses only change by the second, so identical !time queries within TIME_CACHE_TTL share one call.
+TIME_CACHE = {}
+TIME_CACHE_TTL = 1.0
+# Caps on in-flight scrapes overall and per target host, so slow pages can't tie up the HTTP pool.
+SCRAPE_SEM = None  # Created in setup_hook() alongside the other asyncio primitives.
+SCRAPE_LIMIT = 5
+SCRAPE_PER_HOST_LIMIT = 2
+# Entries disappear once no scrape of that host holds a reference to its semaphore.
+SCRAPE_HOST_SEMS = weakref.WeakValueDictionary()
+SCRAPE_CHUNK_SIZE = 4096
+SCRAPE_MAX_BYTES = 65536  # <title> lives in <head>; give up reading well before a full page download.
+TITLE_RE = re.compile(rb'<title[^>]*>([^<]{0,500})</title>', re.IGNORECASE)
+# Matches both <meta charset="..."> and <meta http-equiv="Content-Type" content="text/html; charset=...">.
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
 
 
 # --- Database Initialization ---
 def initialize_database():
-    """Creates the database and the logs table if they don't exist."""
+    """Opens the shared connection and creates the logs table if it doesn't exist."""
+    global DB_CONN
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""
-                       CREATE TABLE IF NOT EXISTS logs
-                       (
-                           id
-                           INTEGER
-                           PRIMARY
-                           KEY
-                           AUTOINCREMENT,
-                           timestamp
-                           TEXT
-                           NOT
-                           NULL,
-                           user
-                           TEXT
-                           NOT
-                           NULL,
-                           message
-                           TEXT
-                           NOT
-                           NULL
-                       )
-                       """)
-        conn.commit()
-        conn.close()
-        logging.info(f"Database '{DB_FILE}' initialized successfully.")
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None, cached_statements=256)
+        # journal_mode=WAL is stored in the database file; the rest apply to this connection only
+        # and are set every time it is opened.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute(SQL_CREATE_LOGS.format(table='logs'))
+        migrate_logs_table(conn)
+        DB_CONN = conn
+        atexit.register(close_database)
+        logger.info("Database '%s' initialized successfully.", DB_FILE)
     except Exception as e:
-        logging.critical(f"FATAL: Could not initialize database. Error: {e}")
+        logger.critical("FATAL: Could not initialize database. Error: %s", e)
         exit()
 
 
+def migrate_logs_table(conn):
+    """Upgrades a logs table created by an older version of Echo to the current schema."""
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(logs)")}
+    if 'display_ts' not in columns:
+        conn.execute("ALTER TABLE logs ADD COLUMN display_ts TEXT")
+        conn.execute(f"UPDATE logs SET display_ts = strftime('{DISPLAY_TS_FORMAT}', timestamp)")
+    if columns['timestamp'].upper() == 'TEXT':
+        # ISO-8601 text timestamps become integer nanoseconds; SQLite can't change a column's type in place.
+        conn.execute("BEGIN")
+        conn.execute(SQL_CREATE_LOGS.format(table='logs_new'))
+        conn.execute("""
+            INSERT INTO logs_new (id, timestamp, user, message, display_ts)
+            SELECT id, CAST(strftime('%s', timestamp) AS INTEGER) * 1000000000, user, message, display_ts FROM logs
+        """)
+        conn.execute("DROP TABLE logs")
+        conn.execute("ALTER TABLE logs_new RENAME TO logs")
+        conn.execute("COMMIT")
+        logger.info("Migrated Chronicle timestamps to integer nanoseconds.")
+
+
+async def write_log_batch(batch):
+    """Inserts a batch of queued log rows in a single transaction."""
+    async with DB_WRITE_LOCK:
+        try:
+            DB_CONN.execute("BEGIN")
+            DB_CONN.executemany(SQL_INSERT_LOG, batch)
+            DB_CONN.execute("COMMIT")
+        except Exception as e:
+            if DB_CONN.in_transaction:
+                DB_CONN.execute("ROLLBACK")
+            logger.error("Failed to write %d entries to Chronicle. Error: %s", len(batch), e)
+
+
+def drain_log_queue(batch):
+    """Moves every row currently waiting in LOG_QUEUE into batch."""
+    while not LOG_QUEUE.empty():
+        batch.append(LOG_QUEUE.get_nowait())
+    return batch
+
+
+async def log_writer():
+    """Background task that coalesces queued !log rows into batched inserts."""
+    while True:
+        batch = [await LOG_QUEUE.get()]
+        try:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        finally:
+            # Runs on cancellation too, so rows already taken off the queue are never dropped.
+            await write_log_batch(drain_log_queue(batch))
+
+
+def close_database():
+    """Closes the shared connection on interpreter shutdown."""
+    global DB_CONN
+    if DB_CONN is not None:
+        DB_CONN.close()
+        DB_CONN = None
+
+
 # --- Bot Logic ---
+class EchoBot(commands.Bot):
+    async def setup_hook(self):
+        """One-time startup: opens the database, HTTP session and log writer, then syncs slash commands.
+
+        Unlike on_ready, this runs exactly once and before any command can be dispatched.
+        """
+        global DB_WRITE_LOCK, LOG_QUEUE, LOG_WRITER_TASK, HTTP, SCRAPE_SEM
+        initialize_database()
+        DB_WRITE_LOCK = asyncio.Lock()
+        SCRAPE_SEM = asyncio.Semaphore(SCRAPE_LIMIT)
+        LOG_QUEUE = asyncio.Queue()
+        LOG_WRITER_TASK = asyncio.create_task(log_writer())
+        HTTP = aiohttp.ClientSession(
+            headers=HTTP_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=15),
+            connector=aiohttp.TCPConnector(limit=20),
+        )
+        await self.tree.sync()
+
+    async def close(self):
+        """Flushes pending log rows and closes the shared HTTP session before shutting down."""
+        if LOG_WRITER_TASK is not None:
+            LOG_WRITER_TASK.cancel()
+            # Wait for the writer to commit the batch it was holding when cancelled.
+            await asyncio.gather(LOG_WRITER_TASK, return_exceptions=True)
+        if LOG_QUEUE is not None and DB_CONN is not None:
+            pending = drain_log_queue([])
+            if pending:
+                await write_log_batch(pending)
+        if HTTP is not None:
+            await HTTP.close()
+        await super().close()
+
+
 intents = discord.Intents.default()
 intents.message_content = True
-client = discord.Client(intents=intents)
+# commands.Bot handles prefix matching and ignores messages from bots, so no on_message handler is needed.
+bot = EchoBot(command_prefix='!', intents=intents)
 
 
-@client.event
+@bot.event
 async def on_ready():
-    """Triggered on bot startup."""
-    initialize_database()
-    logging.info(f'Success! {client.user} is now online and operational.')
+    """Triggered on bot startup and after each gateway reconnect."""
+    logger.info('Success! %s is now online and operational.', bot.user)
 
 
-@client.event
-async def on_message(message):
-    """Event handler for all messages."""
-    if message.author == client.user:
+@bot.event
+async def on_command_error(ctx, error):
+    """Ignores unknown commands and answers malformed arguments with the command's usage."""
+    if isinstance(error, commands.CommandNotFound):
         return
-
-    # Route commands to their respective handlers.
-    if message.content.startswith('!ping'):
-        latency = client.latency * 1000
-        await message.channel.send(f'Pong! System latency is {latency:.2f}ms.')
-    elif message.content.startswith('!scrape'):
-        await handle_scrape_command(message)
-    elif message.content.startswith('!time'):
-        await handle_time_command(message)
-    elif message.content.startswith('!log'):
-        await handle_log_command(message)
-    elif message.content.startswith('!recall'):
-        await handle_recall_command(message)
+    if isinstance(error, commands.UserInputError):
+        await ctx.send(f"Error: {error} Usage: `!{ctx.command.qualified_name} {ctx.command.signature}`")
+        return
+    logger.error("Command '%s' failed.", ctx.command, exc_info=error)
 
 
 # --- Command Handlers ---
-async def handle_recall_command(message):
-    """Retrieves and displays the most recent entries from the Chronicle."""
-    try:
-        # Default to 5 entries if no number is specified.
-        parts = message.content.split()
-        limit = 5
-        if len(parts) > 1 and parts[1].isdigit():
-            limit = int(parts[1])
+@bot.hybrid_command(name='ping')
+async def handle_ping_command(ctx):
+    """Reports the gateway latency."""
+    latency = bot.latency * 1000
+    await ctx.send(f'Pong! System latency is {latency:.2f}ms.')
 
-        limit = min(limit, 20)  # Enforce a maximum limit to prevent spam.
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+@bot.hybrid_command(name='recall')
+async def handle_recall_command(ctx, limit: int = 5):
+    """Retrieves and displays the most recent entries from the Chronicle."""
+    try:
+        limit = max(1, min(limit, 20))  # Enforce a maximum limit to prevent spam.
 
         # SQL query to select the most recent 'limit' entries.
-        cursor.execute("SELECT timestamp, user, message FROM logs ORDER BY id DESC LIMIT ?", (limit,))
+        cursor = DB_CONN.execute(SQL_SELECT_RECENT, (limit,))
         rows = cursor.fetchall()
-        conn.close()
 
         if not rows:
-            await message.channel.send("The Chronicle is empty.")
+            await ctx.send("The Chronicle is empty.")
             return
 
+        # Rows already arrive in chronological order; render them into one description string.
+        lines = [f"**{user}** `{formatted_time}`\n```{log_message}```" for formatted_time, user, log_message in rows]
+        description = "\n".join(lines)
+        # Drop the oldest entries if the combined text would exceed Discord's description limit.
+        while len(description) > EMBED_DESCRIPTION_LIMIT and len(lines) > 1:
+            lines.pop(0)
+            description = "\n".join(lines)
+
         embed = discord.Embed(
             title="Chronicle Recall",
-            description=f"Displaying the last {len(rows)} entries.",
+            description=description[:EMBED_DESCRIPTION_LIMIT],
             color=discord.Color.purple()
         )
+        embed.set_footer(text=f"Displaying the last {len(lines)} entries.")
 
-        # Reverse the rows so they appear in chronological order in the message.
-        for row in reversed(rows):
-            timestamp, user, log_message = row
-            # Format the timestamp for better readability.
-            formatted_time = datetime.fromisoformat(timestamp).strftime('%Y-%m-%d %H:%M:%S UTC')
-            embed.add_field(
-                name=f"Logged by `{user}` at `{formatted_time}`",
-                value=f"```{log_message}```",
-                inline=False
-            )
-
-        await message.channel.send(embed=embed)
+        await ctx.send(embed=embed)
 
     except Exception as e:
-        logging.error(f"Failed to read from Chronicle. Error: {e}")
-        await message.channel.send("❌ Error: Could not recall entries from the Chronicle.")
+        logger.error("Failed to read from Chronicle. Error: %s", e)
+        await ctx.send("❌ Error: Could not recall entries from the Chronicle.")
 
 
-async def handle_log_command(message):
+@bot.hybrid_command(name='log')
+async def handle_log_command(ctx, *, entry: str = ''):
     """Writes a message from a user into the Chronicle database."""
-    log_content = message.content[5:].strip()
+    log_content = entry.strip()
     if not log_content:
-        await message.channel.send("Error: No message provided. Usage: `!log <your message>`")
+        await ctx.send("Error: No message provided. Usage: `!log <your message>`")
         return
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO logs (timestamp, user, message) VALUES (?, ?, ?)",
-            (datetime.utcnow().isoformat(), str(message.author), log_content)
-        )
-        conn.commit()
-        conn.close()
-        logging.info(f"Logged new entry from {message.author}: {log_content}")
-        await message.channel.send("✅ Entry recorded in the Chronicle.")
+        # Reply immediately; log_writer() commits the row with the rest of its batch.
+        # One clock read supplies both the stored nanoseconds and the display string !recall shows as-is.
+        now_ns = time.time_ns()
+        display_ts = time.strftime(DISPLAY_TS_FORMAT, time.gmtime(now_ns // 1_000_000_000))
+        await LOG_QUEUE.put((now_ns, display_ts, str(ctx.author), log_content))
+        logger.info("Logged new entry from %s: %s", ctx.author, log_content)
+        await ctx.send("✅ Entry recorded in the Chronicle.")
     except Exception as e:
-        logging.error(f"Failed to write to Chronicle. Error: {e}")
-        await message.channel.send("❌ Error: Could not record entry in the Chronicle.")
-
-
-# --- Unchanged Handlers ---
-async def handle_scrape_command(message):
-    # This function remains unchanged.
-    parts = message.content.split()
-    if len(parts) < 2:
-        await message.channel.send("Error: No URL provided. Usage: `!scrape <URL>`")
+        logger.error("Failed to write to Chronicle. Error: %s", e)
+        await ctx.send("❌ Error: Could not record entry in the Chronicle.")
+
+
+# --- Network Handlers ---
+async def read_until_title(response):
+    """Streams the response body and stops once the closing </title> tag has arrived."""
+    buf = bytearray()
+    async for chunk in response.content.iter_chunked(SCRAPE_CHUNK_SIZE):
+        # Only rescan the new chunk plus enough overlap to catch a tag split across chunks.
+        start = max(0, len(buf) - len(b'</title>'))
+        buf += chunk
+        if b'</title>' in buf[start:].lower() or len(buf) >= SCRAPE_MAX_BYTES:
+            break
+    return bytes(buf)
+
+
+def host_semaphore(url):
+    """Returns the semaphore limiting concurrent scrapes of url's host."""
+    host = urlsplit(url).hostname or ''
+    sem = SCRAPE_HOST_SEMS.get(host)
+    if sem is None:
+        sem = asyncio.Semaphore(SCRAPE_PER_HOST_LIMIT)
+        SCRAPE_HOST_SEMS[host] = sem
+    return sem
+
+
+def decode_title(raw, head, header_charset):
+    """Decodes title bytes using the HTTP charset, then the page's <meta> charset, then UTF-8."""
+    meta = META_CHARSET_RE.search(head)
+    candidates = [header_charset, meta.group(1).decode('ascii') if meta else None, 'utf-8']
+    for encoding in filter(None, candidates):
+        try:
+            return raw.decode(encoding, 'replace')
+        except LookupError:
+            # Unknown charset name; try the next source.
+            continue
+
+
+@bot.hybrid_command(name='scrape')
+async def handle_scrape_command(ctx, url: str = None):
+    """Fetches a page and reports its title."""
+    if not url:
+        await ctx.send("Error: No URL provided. Usage: `!scrape <URL>`")
         return
-    url = parts[1]
     try:
-        await message.channel.send(f"Beginning reconnaissance on `{url}`...")
-        headers = {'User-Agent': 'Seymore-Bawts-Echo-Probe/1.0'}
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        page_title = soup.title.string if soup.title else "No Title Found"
+        await ctx.send(f"Beginning reconnaissance on `{url}`...")
+        # Wait for a per-host slot first so a queue for one busy host doesn't hold global slots.
+        async with host_semaphore(url), SCRAPE_SEM:
+            async with HTTP.get(url, raise_for_status=True) as response:
+                head = await read_until_title(response)
+                encoding = response.charset
+        # Only <title> is needed, so a regex over the streamed bytes replaces building a parse tree.
+        match = TITLE_RE.search(head)
+        if match:
+            page_title = html.unescape(decode_title(match.group(1), head, encoding)).strip()
+        else:
+            page_title = "No Title Found"
         embed = discord.Embed(title="Reconnaissance Report", description=f"Target: `{url}`", color=discord.Color.blue())
         embed.add_field(name="Page Title", value=f"```{page_title}```", inline=False)
-        embed.set_footer(text=f"Report generated by Echo for {message.author.name}")
-        await message.channel.send(embed=embed)
+        embed.set_footer(text=f"Report generated by Echo for {ctx.author.name}")
+        await ctx.send(embed=embed)
     except Exception as e:
-        await message.channel.send(f"An error occurred during the scrape operation: `{e}`")
+        await ctx.send(f"An error occurred during the scrape operation: `{e}`")
 
 
-async def handle_time_command(message):
-    # This function remains unchanged.
-    parts = message.content.split()
-    if len(parts) < 2:
-        await message.channel.send("Error: No timezone provided. Usage: `!time <Timezone>`")
-        return
-    timezone = parts[1]
+async def fetch_oracle_time(timezone):
+    """Returns the Oracle's response for a timezone, reusing one fetched within the last TIME_CACHE_TTL seconds."""
+    now = time.monotonic()
+    hit = TIME_CACHE.get(timezone)
+    if hit and now - hit[0] < TIME_CACHE_TTL:
+        return hit[1]
     api_endpoint = f"{ORACLE_API_URL}/api/time/{timezone}"
+    async with HTTP.get(api_endpoint, timeout=aiohttp.ClientTimeout(total=10), raise_for_status=True) as response:
+        data = orjson.loads(await response.read())
+    # Stamp with the arrival time; a slow response stamped with the request time would be stored already expired.
+    now = time.monotonic()
+    # Evict expired entries so arbitrary user-supplied keys can't grow the cache without bound.
+    for key in [key for key, (fetched, _) in TIME_CACHE.items() if now - fetched >= TIME_CACHE_TTL]:
+        del TIME_CACHE[key]
+    TIME_CACHE[timezone] = (now, data)
+    return data
+
+
+@bot.hybrid_command(name='time')
+async def handle_time_command(ctx, timezone: str = None):
+    """Queries the Oracle for the current time in a timezone."""
+    if not timezone:
+        await ctx.send("Error: No timezone provided. Usage: `!time <Timezone>`")
+        return
+    if VALID_TZ and timezone not in VALID_TZ:
+        await ctx.send(f"Error: Unknown timezone `{timezone}`. Use an IANA name such as `Europe/London`.")
+        return
     try:
-        await message.channel.send(f"Querying the Oracle for timezone `{timezone}`...")
-        response = requests.get(api_endpoint, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        await ctx.send(f"Querying the Oracle for timezone `{timezone}`...")
+        data = await fetch_oracle_time(timezone)
         embed = discord.Embed(title="Oracle Time Service", description=f"Time information for `{data['timezone']}`",
                               color=discord.Color.green())
         embed.add_field(name="Current Date & Time", value=f"`{data['current_datetime']}`", inline=False)
         embed.add_field(name="UTC Timestamp", value=f"`{data['current_timestamp_utc']}`", inline=False)
-        embed.set_footer(text=f"Query performed by Echo for {message.author.name}")
-        await message.channel.send(embed=embed)
+        embed.set_footer(text=f"Query performed by Echo for {ctx.author.name}")
+        await ctx.send(embed=embed)
     except Exception as e:
-        await message.channel.send(f"An error occurred during the API query: `{e}`")
+        await ctx.send(f"An error occurred during the API query: `{e}`")
 
 
 # --- Execution ---
 if __name__ == "__main__":
     try:
-        client.run(TOKEN)
+        bot.run(TOKEN)
     except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}")
\ No newline at end of file
+        logger.error("An unexpected error occurred: %s", e)
\ No newline at end of file